@@ -1,25 +1,51 @@
+import os
 import pathlib
 from pathlib import Path
-# Fix untuk Windows Path jika diperlukan
-pathlib.PosixPath = pathlib.WindowsPath
+# Fix untuk Windows Path jika diperlukan (di Linux baris ini justru merusak pathlib)
+if os.name == "nt": pathlib.PosixPath = pathlib.WindowsPath
 
-import os
-import shutil
-import uuid
 import io 
+import sys
+import codecs
+import re
+import random
+import logging
+import threading
+import csv
+import math
+import gzip
+import json
+import hashlib
+import time
+import asyncio
+import multiprocessing
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from email.utils import formatdate, parsedate_to_datetime
 from typing import List, Optional
 
-import uvicorn
+import hashing
+import numpy as np
 import torch # Library Utama AI (PyTorch)
-from PIL import Image # Library pengolah gambar
-from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Form
+import torchvision
+from PIL import Image, ImageOps # Library pengolah gambar
+from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Form, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
 from fastapi.staticfiles import StaticFiles
-from passlib.context import CryptContext
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+
+try:
+    import brotli # Opsional: tanpa ini respons katalog hanya dikompres gzip
+except ImportError:
+    brotli = None
 
 # --- GABUNGAN IMPORTS ---
-from pydantic import BaseModel
-from sqlalchemy import Column, Integer, String, Text, Float, ForeignKey, create_engine
+from pydantic import BaseModel, ValidationError
+from sqlalchemy import Column, Integer, String, Text, Float, ForeignKey, MetaData, Table, cast, create_engine, event, func, insert, or_, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import Session, sessionmaker, relationship
 
@@ -37,18 +63,102 @@ os.makedirs(RAMBU_IMAGES_DIR, exist_ok=True)
 os.makedirs(PROFILE_IMAGES_DIR, exist_ok=True)
 os.makedirs(UPLOADS_DIR, exist_ok=True)
 
+# --- KONFIGURASI MODEL ---
+MODEL_PATH = os.path.join(BASE_DIR, "best.pt")
+# Hasil ekspor TorchScript dari best.pt, dibuat sekali lalu dipakai ulang saat boot berikutnya
+MODEL_CACHE_PATH = os.path.join(BASE_DIR, "best.torchscript")
+# Clone lokal ultralytics/yolov5 agar bisa memuat best.pt tanpa internet
+YOLOV5_DIR = os.getenv("YOLOV5_DIR", os.path.join(BASE_DIR, "yolov5"))
+AI_BACKEND = os.getenv("AI_BACKEND", "torchscript")  # "torchscript" atau "hub"
+AI_IMG_SIZE = 640
+AI_CONF = 0.45 # Threshold confidence default (min_conf per request)
+# Batas bawah NMS = min_conf terendah yang diterima API; threshold per request diterapkan sesudahnya
+AI_CONF_MIN = float(os.getenv("AI_CONF_MIN", "0.1"))
+AI_IOU = 0.45
+
+# --- KONFIGURASI WORKER ---
+# Mode produksi multi-worker: gunicorn -c gunicorn.conf.py app:app (lihat gunicorn.conf.py)
+WORKERS = int(os.getenv("RAMBUID_WORKERS", "1"))
+# Model dimuat di proses master sebelum fork, bobotnya dipakai bersama (copy-on-write)
+PRELOAD_MODEL = os.getenv("RAMBUID_PRELOAD_MODEL") == "1"
+# Thread intra-op torch per worker; default inti CPU dibagi rata antar worker
+TORCH_THREADS = int(os.getenv("TORCH_THREADS", str(max(1, (os.cpu_count() or 1) // WORKERS))))
+
+# --- KONFIGURASI INFERENSI ---
+# Gambar yang masuk dikumpulkan lalu dijalankan ke model per batch kecil
+AI_MAX_BATCH = int(os.getenv("AI_MAX_BATCH", "8"))         # Maks. gambar per batch
+AI_MAX_WAIT_MS = float(os.getenv("AI_MAX_WAIT_MS", "10"))  # Maks. waktu tunggu mengisi batch
+AI_QUEUE_SIZE = int(os.getenv("AI_QUEUE_SIZE", "64"))      # Lebih dari ini -> 503
+
+# --- KONFIGURASI CACHE DETEKSI ---
+# Hasil deteksi disimpan per perceptual hash (dHash 256 bit) gambar; frame yang hampir sama tidak diinferensi ulang
+DETECT_CACHE_SIZE = int(os.getenv("DETECT_CACHE_SIZE", "512"))    # 0 = nonaktif
+DETECT_CACHE_TTL = float(os.getenv("DETECT_CACHE_TTL", "300"))     # Detik
+DETECT_CACHE_DISTANCE = int(os.getenv("DETECT_CACHE_DISTANCE", "12")) # Jarak Hamming maks. (dari 256 bit)
+
+# --- KONFIGURASI LIVE KAMERA (WebSocket) ---
+WS_SMOOTH_FRAMES = int(os.getenv("WS_SMOOTH_FRAMES", "5")) # Jendela voting label per koneksi
+WS_SMOOTH_MIN = int(os.getenv("WS_SMOOTH_MIN", "3"))       # Label dianggap stabil bila muncul >= ini dalam jendela
+
+# --- KONFIGURASI LOG ---
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Pada level DEBUG, kandidat deteksi hanya dicatat untuk sebagian request (0..1)
+DEBUG_SAMPLE_RATE = float(os.getenv("DEBUG_SAMPLE_RATE", "0.01"))
+
+logger = logging.getLogger("rambuid")
+logger.setLevel(LOG_LEVEL)
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    logger.addHandler(_handler)
+
+# --- KONFIGURASI UPLOAD ---
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+MAX_IMPORT_BYTES = int(os.getenv("MAX_IMPORT_BYTES", str(100 * 1024 * 1024))) # Bulk import Jelajahi
+IMPORT_CHUNK = 1000      # Baris per transaksi executemany
+IMPORT_MAX_ERRORS = 1000 # Maks. error per baris yang dilaporkan
+UPLOAD_CHUNK = 256 * 1024
+
+# --- KONFIGURASI GAMBAR PROFIL ---
+# Disimpan per hash isi (dedupe) sebagai WebP; varian: nama_file + akhiran -> sisi terpanjang
+PROFILE_VARIANTS = {"": 512, "_thumb": 128}
+PROFILE_NAME_RE = re.compile(r"^([0-9a-f]{32})(_thumb)?\.webp$")
+ORPHAN_GRACE_S = 3600 # File baru di bawah umur ini tidak ikut dibersihkan (upload yang sedang berjalan)
+# GC file yatim saat startup menghapus semua file yang tidak direferensikan DB yang sedang dipakai.
+# DB baru/restore atau DATABASE_URL yang salah akan menghapus semua foto, jadi hanya jalan bila diminta.
+PROFILE_GC = os.getenv("PROFILE_GC") == "1"
+
 # --- KONFIGURASI DATABASE ---
-DATABASE_URL = "sqlite:///./rambuid.db"
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./rambuid.db")
 engine = create_engine(
     DATABASE_URL, 
     connect_args={"check_same_thread": False, "timeout": 20},
     pool_pre_ping=True,
     pool_recycle=3600,
 )
+
+# WAL: pembaca tidak menunggu penulis, dan commit tidak fsync setiap kali (synchronous=NORMAL)
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -32000,     # KiB per koneksi (~32 MB)
+    "temp_store": "MEMORY",
+    "mmap_size": 268435456,   # 256 MB
+}
+
+@event.listens_for(engine, "connect")
+def _sqlite_pragmas(dbapi_conn, connection_record):
+    cur = dbapi_conn.cursor()
+    for k, v in SQLITE_PRAGMAS.items(): cur.execute(f"PRAGMA {k}={v}")
+    cur.close()
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
-pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
+# --- KONFIGURASI AUTH ---
+# Hash PBKDF2 dijalankan di process pool terbatas (lihat hashing.py), rounds lewat PBKDF2_ROUNDS
+# Pool dibuat per worker: default dibagi rata supaya total proses hash tidak melebihi jumlah core
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", str(max(1, (os.cpu_count() or 1) // WORKERS))))
 
 # --- MODEL DATABASE ---
 class Rambu(Base):
@@ -118,6 +228,7 @@ class UserProfileResponse(BaseModel):
     nama_lengkap: Optional[str]
     alamat: Optional[str]
     profile_image: Optional[str]
+    profile_thumb: Optional[str] = None
     class Config:
         from_attributes = True
 
@@ -126,6 +237,17 @@ class JelajahiCreate(BaseModel):
     latitude: float
     longitude: float
 
+class JelajahiImportError(BaseModel):
+    baris: int
+    pesan: str
+
+class JelajahiImportResponse(BaseModel):
+    total: int
+    ditambahkan: int
+    duplikat: int
+    gagal: int
+    error: List[JelajahiImportError]
+
 class JelajahiResponse(BaseModel):
     id: int
     rambu_id: int
@@ -149,9 +271,20 @@ class JelajahiWithRambuResponse(BaseModel):
     deskripsi_en: Optional[str] = None
     kategori_en: Optional[str] = None
     
+    # Hanya diisi pada pencarian lat/lng (radius / terdekat)
+    jarak_m: Optional[float] = None
+    
     class Config:
         from_attributes = True
 
+class JelajahiCluster(BaseModel):
+    latitude: float
+    longitude: float
+    jumlah: int
+    # Diisi bila cluster hanya berisi satu lokasi
+    id: Optional[int] = None
+    rambu_id: Optional[int] = None
+
 class AIResponse(BaseModel):
     status: str
     terdeteksi: bool
@@ -159,10 +292,37 @@ class AIResponse(BaseModel):
     confidence: Optional[float] = None
     deskripsi: Optional[str] = None
     kategori: Optional[str] = None
+    nama_en: Optional[str] = None
+    deskripsi_en: Optional[str] = None
+    kategori_en: Optional[str] = None
     pesan: str
+    # Diisi bila ?semua=true: setiap rambu di frame beserta bounding box-nya
+    deteksi: Optional[List["DeteksiItem"]] = None
+
+class DeteksiItem(BaseModel):
+    kelas: int
+    terdeteksi: bool
+    nama_rambu: str
+    confidence: float
+    bbox: List[float] # x1, y1, x2, y2 (piksel gambar asli)
+    deskripsi: Optional[str] = None
+    kategori: Optional[str] = None
+    nama_en: Optional[str] = None
+    deskripsi_en: Optional[str] = None
+    kategori_en: Optional[str] = None
+
+AIResponse.model_rebuild()
 
 # --- SETUP APP ---
 app = FastAPI(title="RambuID API", version="1.0.0")
+class ImmutableStaticFiles(StaticFiles):
+    # Nama file gambar profil tidak pernah dipakai ulang untuk isi lain, jadi aman di-cache selamanya
+    def file_response(self, *args, **kwargs):
+        resp = super().file_response(*args, **kwargs)
+        resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return resp
+
+app.mount("/static/images/profiles", ImmutableStaticFiles(directory=PROFILE_IMAGES_DIR), name="profiles")
 app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 app.add_middleware(
     CORSMiddleware,
@@ -172,23 +332,473 @@ app.add_middleware(
 )
 Base.metadata.create_all(bind=engine)
 
+class BatasUpload:
+    """Batas ukuran body request. Content-Length yang kebesaran ditolak sebelum multipart di-parse;
+    upload chunked (tanpa Content-Length) dihitung langsung dari stream ASGI mentah."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http": return await self.app(scope, receive, send)
+        # Sisa 64 KB untuk header form multipart
+        batas = (MAX_IMPORT_BYTES if scope["path"] == "/jelajahi/import" else MAX_UPLOAD_BYTES) + 64 * 1024
+        size = Headers(scope=scope).get("content-length")
+        if size and size.isdigit() and int(size) > batas:
+            return await JSONResponse({"detail": "Ukuran file terlalu besar"}, status_code=413)(scope, receive, send)
+        diterima = 0
+
+        async def receive_terbatas():
+            nonlocal diterima
+            msg = await receive()
+            if msg["type"] == "http.request":
+                diterima += len(msg.get("body", b""))
+                # Diteruskan FastAPI apa adanya saat parsing body, jadi client mendapat 413
+                if diterima > batas: raise HTTPException(413, "Ukuran file terlalu besar")
+            return msg
+
+        await self.app(scope, receive_terbatas, send)
+
+app.add_middleware(BatasUpload)
+
+# --- METRIK ---
+# Format teks Prometheus, tanpa dependensi tambahan. Nilai per proses (tiap worker gunicorn punya sendiri).
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _labels(names, values) -> str:
+    if not names: return ""
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, values)) + "}"
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help, tuple(labels), tuple(buckets)
+        self.series = {} # nilai label -> [hitungan per bucket..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        with self.lock:
+            s = self.series.setdefault(labels, [0] * len(self.buckets) + [0.0, 0])
+            for i, b in enumerate(self.buckets):
+                if value <= b: s[i] += 1
+            s[-2] += value
+            s[-1] += 1
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock: series = {k: list(v) for k, v in self.series.items()}
+        for values, s in sorted(series.items()):
+            for b, c in zip((*self.buckets, "+Inf"), (*s[:len(self.buckets)], s[-1])):
+                out.append(f"{self.name}_bucket{_labels((*self.labels, 'le'), (*values, b))} {c}")
+            out.append(f"{self.name}_sum{_labels(self.labels, values)} {s[-2]}")
+            out.append(f"{self.name}_count{_labels(self.labels, values)} {s[-1]}")
+        return out
+
+def _metric(name: str, kind: str, help: str, value) -> List[str]:
+    return [f"# HELP {name} {help}", f"# TYPE {name} {kind}", f"{name} {value}"]
+
+HTTP_LATENCY = Histogram("rambuid_http_request_duration_seconds", "Latensi request per route", ("method", "route", "status"))
+DETEKSI_STAGE = Histogram("rambuid_deteksi_stage_seconds", "Latensi per tahap deteksi", ("stage",))
+MODEL_BATCH = Histogram("rambuid_model_batch_size", "Jumlah gambar per batch inferensi", buckets=(1, 2, 4, 8, 16, 32))
+
+@contextmanager
+def ukur(stage: str):
+    t0 = time.perf_counter()
+    try: yield
+    finally: DETEKSI_STAGE.observe(time.perf_counter() - t0, stage)
+
+@app.middleware("http")
+async def catat_latensi(request: Request, call_next):
+    t0 = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # Pakai template route ("/users/{uid}/profile") agar label tidak meledak per id
+        route = getattr(request.scope.get("route"), "path", "unmatched")
+        HTTP_LATENCY.observe(time.perf_counter() - t0, request.method, route, status)
+
+# --- INDEKS SPASIAL ---
+# R*Tree atas Jelajahi.latitude/longitude, disinkronkan oleh trigger SQLite.
+# Bila modul rtree tidak tersedia, dipakai indeks B-tree (latitude, longitude).
+jelajahi_rtree = Table(
+    "jelajahi_rtree", MetaData(),
+    Column("id", Integer, primary_key=True),
+    Column("min_lat", Float), Column("max_lat", Float),
+    Column("min_lng", Float), Column("max_lng", Float),
+)
+
+def _init_spatial_index() -> bool:
+    try:
+        with engine.begin() as conn:
+            baru = conn.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'jelajahi_rtree'").first() is None
+            conn.exec_driver_sql("CREATE VIRTUAL TABLE IF NOT EXISTS jelajahi_rtree USING rtree(id, min_lat, max_lat, min_lng, max_lng)")
+            conn.exec_driver_sql("""CREATE TRIGGER IF NOT EXISTS jelajahi_rtree_ai AFTER INSERT ON jelajahi BEGIN
+                INSERT INTO jelajahi_rtree VALUES (new.id, new.latitude, new.latitude, new.longitude, new.longitude); END""")
+            conn.exec_driver_sql("""CREATE TRIGGER IF NOT EXISTS jelajahi_rtree_au AFTER UPDATE ON jelajahi BEGIN
+                DELETE FROM jelajahi_rtree WHERE id = old.id;
+                INSERT INTO jelajahi_rtree VALUES (new.id, new.latitude, new.latitude, new.longitude, new.longitude); END""")
+            conn.exec_driver_sql("""CREATE TRIGGER IF NOT EXISTS jelajahi_rtree_ad AFTER DELETE ON jelajahi BEGIN
+                DELETE FROM jelajahi_rtree WHERE id = old.id; END""")
+            if baru:
+                conn.exec_driver_sql("INSERT INTO jelajahi_rtree SELECT id, latitude, latitude, longitude, longitude FROM jelajahi")
+        return True
+    except Exception as e:
+        logger.warning("R*Tree tidak tersedia, pakai indeks lat/lng biasa: %s", e)
+        with engine.begin() as conn:
+            conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_jelajahi_lat_lng ON jelajahi (latitude, longitude)")
+        return False
+
+SPATIAL_RTREE = _init_spatial_index()
+
+# --- INDEKS PENCARIAN (FTS5) ---
+# External-content FTS5 di atas tabel rambu, disinkronkan oleh trigger saat insert/update/delete
+FTS_KOLOM = ["nama", "deskripsi", "nama_en", "deskripsi_en", "kategori", "kategori_en"]
+
+def _init_search_index() -> bool:
+    kolom = ", ".join(FTS_KOLOM)
+    new = ", ".join(f"new.{k}" for k in FTS_KOLOM)
+    old = ", ".join(f"old.{k}" for k in FTS_KOLOM)
+    try:
+        with engine.begin() as conn:
+            baru = conn.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'rambu_fts'").first() is None
+            conn.exec_driver_sql(f"""CREATE VIRTUAL TABLE IF NOT EXISTS rambu_fts USING fts5({kolom},
+                content='rambu', content_rowid='id', tokenize='unicode61 remove_diacritics 2')""")
+            conn.exec_driver_sql(f"""CREATE TRIGGER IF NOT EXISTS rambu_fts_ai AFTER INSERT ON rambu BEGIN
+                INSERT INTO rambu_fts(rowid, {kolom}) VALUES (new.id, {new}); END""")
+            conn.exec_driver_sql(f"""CREATE TRIGGER IF NOT EXISTS rambu_fts_ad AFTER DELETE ON rambu BEGIN
+                INSERT INTO rambu_fts(rambu_fts, rowid, {kolom}) VALUES ('delete', old.id, {old}); END""")
+            conn.exec_driver_sql(f"""CREATE TRIGGER IF NOT EXISTS rambu_fts_au AFTER UPDATE ON rambu BEGIN
+                INSERT INTO rambu_fts(rambu_fts, rowid, {kolom}) VALUES ('delete', old.id, {old});
+                INSERT INTO rambu_fts(rowid, {kolom}) VALUES (new.id, {new}); END""")
+            if baru:
+                conn.exec_driver_sql("INSERT INTO rambu_fts(rambu_fts) VALUES ('rebuild')")
+        return True
+    except Exception as e:
+        logger.warning("FTS5 tidak tersedia, pencarian memakai LIKE: %s", e)
+        return False
+
+SEARCH_FTS = _init_search_index()
+
+# Indeks ekspresi untuk dedupe import: koordinat dibulatkan 5 desimal (~1 m) + rambu_id
+with engine.begin() as _conn:
+    _conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_jelajahi_dedupe ON jelajahi (rambu_id, round(latitude, 5), round(longitude, 5))")
+
+# --- VERSI DATA ---
+# Versi per tabel disimpan di DB dan dinaikkan trigger, jadi perubahan dari luar app maupun dari
+# worker lain ikut terlihat. Cache in-memory (katalog, indeks kelas, deteksi) membandingkan versi ini.
+DATA_VERSI_TABEL = ("rambu", "jelajahi")
+DATA_VERSI_TTL = float(os.getenv("DATA_VERSI_TTL", "1")) # Detik antar pembacaan tabel data_versi
+
+def _init_data_versi():
+    with engine.begin() as conn:
+        conn.exec_driver_sql("CREATE TABLE IF NOT EXISTS data_versi (tabel TEXT PRIMARY KEY, versi INTEGER NOT NULL DEFAULT 0)")
+        for tabel in DATA_VERSI_TABEL:
+            conn.exec_driver_sql(f"INSERT OR IGNORE INTO data_versi (tabel, versi) VALUES ('{tabel}', 0)")
+            for aksi in ("INSERT", "UPDATE", "DELETE"):
+                conn.exec_driver_sql(f"""CREATE TRIGGER IF NOT EXISTS {tabel}_versi_{aksi.lower()} AFTER {aksi} ON {tabel} BEGIN
+                    UPDATE data_versi SET versi = versi + 1 WHERE tabel = '{tabel}'; END""")
+
+_init_data_versi()
+
+class DataVersi:
+    """Baca tabel data_versi paling sering sekali per DATA_VERSI_TTL detik: data_versi["rambu"] -> int."""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.waktu = float("-inf")
+        self.versi = {}
+
+    def __getitem__(self, tabel: str) -> int:
+        if time.monotonic() - self.waktu >= self.ttl: self.segarkan()
+        return self.versi.get(tabel, 0)
+
+    def segarkan(self):
+        with engine.connect() as conn:
+            versi = dict(conn.execute(text("SELECT tabel, versi FROM data_versi")).all())
+        self.versi, self.waktu = versi, time.monotonic()
+
+data_versi = DataVersi(DATA_VERSI_TTL)
+
 # --- LOAD AI ---
+class HubDetector:
+    """Model torch.hub (AutoShape) apa adanya, dipakai bila ekspor TorchScript gagal."""
+    backend = "hub"
+
+    def __init__(self, model):
+        self.model = model
+        self.names = _class_names(model.names)
+
+    def __call__(self, imgs) -> List[torch.Tensor]:
+        # Tiap elemen: tensor (n, 6) = x1, y1, x2, y2, confidence, class
+        return [d.cpu() for d in self.model(imgs, size=AI_IMG_SIZE).xyxy]
+
+class TorchScriptDetector:
+    """Model hasil ekspor TorchScript. Letterbox dan NMS dikerjakan di sini, tanpa kode YOLOv5."""
+    backend = "torchscript"
+
+    def __init__(self, module, names: dict, img_size: int):
+        self.module = module
+        self.names = names
+        self.img_size = img_size
+
+    def __call__(self, imgs) -> List[torch.Tensor]:
+        batch, metas = zip(*(_letterbox(img, self.img_size) for img in imgs))
+        with torch.inference_mode():
+            pred = self.module(torch.stack(batch))
+        if isinstance(pred, (list, tuple)): pred = pred[0]
+        return [_scale_boxes(_nms(p, AI_CONF_MIN, AI_IOU), meta) for p, meta in zip(pred, metas)]
+
+def _class_names(names) -> dict:
+    return {int(k): v for k, v in names.items()} if isinstance(names, dict) else dict(enumerate(names))
+
+def _letterbox(img: Image.Image, size: int):
+    w, h = img.size
+    r = min(size / w, size / h)
+    nw, nh = round(w * r), round(h * r)
+    px, py = (size - nw) // 2, (size - nh) // 2
+    canvas = Image.new("RGB", (size, size), (114, 114, 114))
+    canvas.paste(img.resize((nw, nh), Image.BILINEAR), (px, py))
+    x = torch.from_numpy(np.array(canvas)).permute(2, 0, 1).float().div_(255)
+    return x, (r, px, py, w, h)
+
+def _nms(p: torch.Tensor, conf: float, iou: float, max_det: int = 300) -> torch.Tensor:
+    # p: (N, 5 + nc) = cx, cy, w, h, objectness, skor kelas...
+    p = p[p[:, 4] > conf]
+    score, cls = (p[:, 5:] * p[:, 4:5]).max(1)
+    keep = score > conf
+    p, score, cls = p[keep], score[keep], cls[keep].float()
+    half = p[:, 2:4] / 2
+    boxes = torch.cat((p[:, :2] - half, p[:, :2] + half), 1)
+    i = torchvision.ops.batched_nms(boxes, score, cls, iou)[:max_det]
+    return torch.cat((boxes[i], score[i, None], cls[i, None]), 1)
+
+def _scale_boxes(det: torch.Tensor, meta) -> torch.Tensor:
+    r, px, py, w, h = meta
+    det[:, [0, 2]] = ((det[:, [0, 2]] - px) / r).clamp(0, w)
+    det[:, [1, 3]] = ((det[:, [1, 3]] - py) / r).clamp(0, h)
+    return det
+
+def _model_signature() -> dict:
+    # Isi file, bukan mtime: checkout/scp/rsync mengubah mtime tanpa mengubah bobot
+    sha = hashlib.sha256()
+    with open(MODEL_PATH, "rb") as f:
+        while chunk := f.read(1 << 20): sha.update(chunk)
+    return {"sha256": sha.hexdigest(), "img_size": AI_IMG_SIZE, "torch": torch.__version__}
+
+def _load_hub_model():
+    if os.path.isdir(YOLOV5_DIR):
+        model = torch.hub.load(YOLOV5_DIR, 'custom', path=MODEL_PATH, source='local', device='cpu')
+    else:
+        # Tanpa force_reload: repo yolov5 di cache torch.hub dipakai ulang, hanya diunduh sekali
+        model = torch.hub.load('ultralytics/yolov5', 'custom', path=MODEL_PATH, device='cpu',
+                               skip_validation=True, trust_repo=True)
+    model.conf = AI_CONF_MIN
+    model.iou = AI_IOU
+    return model
+
+def _export_torchscript(hub_model):
+    core = getattr(hub_model.model, "model", hub_model.model)  # DetectMultiBackend -> DetectionModel
+    core.float().eval()
+    detect = core.model[-1]
+    detect.export = True  # Detect hanya mengembalikan prediksi gabungan
+    try:
+        with torch.no_grad():
+            ts = torch.jit.trace(core, torch.zeros(1, 3, AI_IMG_SIZE, AI_IMG_SIZE), strict=False)
+    finally:
+        detect.export = False
+    meta = {**_model_signature(), "names": _class_names(hub_model.names)}
+    tmp = f"{MODEL_CACHE_PATH}.{os.getpid()}.tmp" # Per proses: beberapa worker bisa mengekspor bersamaan
+    ts.save(tmp, _extra_files={"meta.json": json.dumps(meta)})
+    os.replace(tmp, MODEL_CACHE_PATH)
+
+def _load_torchscript():
+    if not os.path.exists(MODEL_CACHE_PATH): return None
+    extra = {"meta.json": ""}
+    module = torch.jit.load(MODEL_CACHE_PATH, map_location="cpu", _extra_files=extra)
+    meta = json.loads(extra["meta.json"] or "{}")
+    names = meta.pop("names", None)
+    if not names or meta != _model_signature():
+        logger.info("Cache TorchScript kedaluwarsa, ekspor ulang dari best.pt")
+        return None
+    return TorchScriptDetector(module.eval(), _class_names(names), AI_IMG_SIZE)
+
+# --- KELAS MODEL ---
+NAMA_KELAS = {
+    0: 'Balai Pertolongan Pertama',
+    1: 'Banyak Anak-Anak',
+    2: 'Banyak Tikungan Pertama Kanan',
+    3: 'Banyak Tikungan Pertama Kiri',
+    4: 'Berhenti',
+    5: 'Dilarang Belok Kanan',
+    6: 'Dilarang Belok Kiri',
+    7: 'Dilarang Berhenti',
+    8: 'Dilarang Masuk',
+    9: 'Dilarang Mendahului',
+    10: 'Dilarang Parkir',
+    11: 'Dilarang Putar Balik',
+    12: 'Gereja',
+    13: 'Hati-Hati',
+    14: 'Ikuti Bundaran',
+    15: 'Jalur Sepeda',
+    16: 'Kecepatan Maks. 30 km',
+    17: 'Kecepatan Maks. 40 km',
+    18: 'Lajur Kiri',
+    19: 'Lampu Lalu Lintas',
+    20: 'Larangan Muatan - 10 ton',
+    21: 'Masjid',
+    22: 'Pemberhentian Bus',
+    23: 'Penyebrangan Pejalan Kaki',
+    24: 'Peringatan Perlintasan Kereta Api',
+    25: 'Perintah Jalur Penyebrangan',
+    26: 'Persimpangan 3 Prioritas',
+    27: 'Persimpangan 3 Prioritas Kanan',
+    28: 'Persimpangan 3 Prioritas Kiri',
+    29: 'Persimpangan 3 Sisi Kiri',
+    30: 'Persimpangan 4',
+    31: 'Pilih Salah Satu Jalur',
+    32: 'Polisi Tidur',
+    33: 'Pom Bensin',
+    34: 'Putar Balik',
+    35: 'Rumah Sakit',
+    36: 'Tempat Parkir',
+    37: 'Tikungan Ganda Pertama Ke Kanan',
+    38: 'Tikungan Ganda Pertama Ke Kiri',
+    39: 'Tikungan Ke Kanan'
+}
+
+# Kelas yang belum cukup akurat, hasilnya diabaikan
+BLACKLIST = [
+    'Dilarang Mendahului', 'Banyak Tikungan Pertama Kanan', 'Banyak Tikungan Pertama Kiri',
+    'Tikungan Ganda Pertama Ke Kanan', 'Tikungan Ganda Pertama Ke Kiri', 'Kecepatan Maks. 30 km', 
+    'Lajur Kiri', 'Larangan Muatan - 10 ton', 'Tikungan Ke Kanan', 'Persimpangan 3 Prioritas'
+]
+BLACKLIST_IDS = torch.tensor([i for i, n in NAMA_KELAS.items() if n in BLACKLIST])
+
 ai_model = None
+ai_model_info = {"backend": None, "waktu_muat": None}
+
 @app.on_event("startup")
 def load_ai_model():
     global ai_model
+    if ai_model is not None: return # Sudah dimuat master sebelum fork
+    t0 = time.perf_counter()
     try:
-        model_path = os.path.join(BASE_DIR, "best.pt")
-        if os.path.exists(model_path):
-            print(f"Memuat model AI dari: {model_path}")
-            ai_model = torch.hub.load('ultralytics/yolov5', 'custom', path=model_path, force_reload=True)
-            ai_model.conf = 0.45 # Threshold confidence
-            ai_model.iou = 0.45
-            print("Model AI Siap!")
-        else:
-            print("WARNING: best.pt tidak ditemukan.")
-    except Exception as e:
-        print(f"Error load AI: {e}")
+        if not os.path.exists(MODEL_PATH):
+            logger.warning("best.pt tidak ditemukan: %s", MODEL_PATH)
+            return
+        logger.info("Memuat model AI dari: %s", MODEL_PATH)
+        model = _load_torchscript() if AI_BACKEND == "torchscript" else None
+        if model is None:
+            hub_model = _load_hub_model()
+            if AI_BACKEND == "torchscript":
+                try:
+                    _export_torchscript(hub_model)
+                    model = _load_torchscript()
+                except Exception as e:
+                    logger.warning("Ekspor TorchScript gagal, pakai model hub: %s", e)
+            model = model or HubDetector(hub_model)
+        ai_model = model
+        ai_model_info.update(backend=model.backend, waktu_muat=round(time.perf_counter() - t0, 3))
+        logger.info("Model AI siap (%s, %s s)", model.backend, ai_model_info["waktu_muat"])
+    except Exception:
+        logger.exception("Gagal memuat model AI")
+
+if PRELOAD_MODEL:
+    # Master tidak memakai thread pool OpenMP sebelum fork, supaya worker tidak hang
+    torch.set_num_threads(1)
+    load_ai_model()
+
+@app.on_event("startup")
+def init_worker():
+    torch.set_num_threads(TORCH_THREADS)
+    # Koneksi pool milik master tidak boleh dipakai bersama oleh proses hasil fork
+    engine.dispose(close=False)
+    # Cache in-memory per worker divalidasi lewat tabel data_versi yang dipakai bersama di SQLite
+    data_versi.segarkan()
+
+# --- ANTRIAN INFERENSI ---
+class InferenceBatcher:
+    """Worker inferensi tunggal: request mengantri, model dipanggil per batch di thread terpisah
+    sehingga event loop tidak pernah terblokir oleh forward pass."""
+
+    def __init__(self, max_batch: int, max_wait_ms: float, queue_size: int):
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait_ms / 1000
+        self.queue_size = queue_size
+        self.queue: Optional[asyncio.Queue] = None
+        self.worker: Optional[asyncio.Task] = None
+        # Satu thread saja: model tidak dipanggil paralel, batch yang memberi throughput
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ai")
+
+    def start(self):
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.worker:
+            self.worker.cancel()
+            try: await self.worker
+            except asyncio.CancelledError: pass
+        self.executor.shutdown(wait=False)
+
+    def qsize(self) -> int:
+        return self.queue.qsize() if self.queue else 0
+
+    async def submit(self, img):
+        fut = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((img, fut, time.perf_counter()))
+        except asyncio.QueueFull:
+            raise HTTPException(503, "Server sibuk, coba lagi", headers={"Retry-After": "1"})
+        return await fut
+
+    async def _collect(self):
+        batch = [await self.queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait()); continue
+            timeout = deadline - loop.time()
+            if timeout <= 0: break
+            try: batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError: break
+        now = time.perf_counter()
+        for _, _, t in batch: DETEKSI_STAGE.observe(now - t, "queue_wait")
+        # Request yang sudah dibatalkan client tidak perlu diproses
+        return [(img, fut) for img, fut, _ in batch if not fut.done()]
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            if not batch: continue
+            MODEL_BATCH.observe(len(batch))
+            try:
+                with ukur("inference"):
+                    hasil = await loop.run_in_executor(self.executor, self._predict, [img for img, _ in batch])
+            except Exception as e:
+                for _, fut in batch:
+                    if not fut.done(): fut.set_exception(e)
+                continue
+            for (_, fut), h in zip(batch, hasil):
+                if not fut.done(): fut.set_result(h)
+
+    @staticmethod
+    def _predict(imgs):
+        return ai_model(imgs)
+
+ai_batcher = InferenceBatcher(AI_MAX_BATCH, AI_MAX_WAIT_MS, AI_QUEUE_SIZE)
+
+@app.on_event("startup")
+async def start_ai_batcher():
+    ai_batcher.start()
+
+@app.on_event("shutdown")
+async def stop_ai_batcher():
+    await ai_batcher.stop()
 
 # --- HELPERS ---
 def get_db():
@@ -197,218 +807,771 @@ def get_db():
     except: db.rollback(); raise
     finally: db.close()
 
-def hash_password(p: str): return pwd_context.hash(p)
-def verify_password(p: str, h: str): return pwd_context.verify(p, h)
+hash_pool: Optional[ProcessPoolExecutor] = None
+
+@app.on_event("startup")
+def start_hash_pool():
+    global hash_pool
+    # spawn, bukan fork: proses ini sudah punya thread (torch, batcher, threadpool) yang tidak aman di-fork
+    hash_pool = ProcessPoolExecutor(max_workers=HASH_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+@app.on_event("shutdown")
+def stop_hash_pool():
+    if hash_pool: hash_pool.shutdown(wait=False, cancel_futures=True)
+
+async def hash_password(p: str) -> str:
+    return await asyncio.get_running_loop().run_in_executor(hash_pool, hashing.hash_password, p)
+
+async def verify_password(p: str, h: str):
+    # -> (cocok, hash_baru atau None)
+    return await asyncio.get_running_loop().run_in_executor(hash_pool, hashing.verify_password, p, h)
+
+# --- PENYIMPANAN GAMBAR PROFIL ---
+def save_profile_image(data: bytes) -> str:
+    """Simpan foto profil per hash isi sebagai varian WebP. Upload yang sama persis memakai file yang sama."""
+    name = hashlib.sha256(data).hexdigest()[:32]
+    paths = {suffix: os.path.join(PROFILE_IMAGES_DIR, f"{name}{suffix}.webp") for suffix in PROFILE_VARIANTS}
+    url = f"/static/images/profiles/{name}.webp"
+    try:
+        # Dedupe: mtime diperbarui supaya delete_if_orphan dari request lain melewati file ini
+        # sampai baris user yang baru memakainya sempat di-commit
+        for p in paths.values(): os.utime(p)
+        return url
+    except FileNotFoundError: pass # Belum ada (atau tinggal sebagian): tulis semua varian
+    try:
+        img = Image.open(io.BytesIO(data))
+        img.draft("RGB", (max(PROFILE_VARIANTS.values()),) * 2)
+        img = ImageOps.exif_transpose(img).convert("RGB")
+    except Exception:
+        raise HTTPException(400, "File bukan gambar")
+    for suffix, size in PROFILE_VARIANTS.items():
+        v = img.copy()
+        v.thumbnail((size, size))
+        tmp = f"{paths[suffix]}.{os.getpid()}.tmp"
+        v.save(tmp, "WEBP", quality=80, method=4)
+        os.replace(tmp, paths[suffix])
+    return url
+
+def _profile_file(url: Optional[str]) -> Optional[str]:
+    # Nama file di PROFILE_IMAGES_DIR untuk URL profil, None bila bukan file lokal
+    if not url or url.startswith("http"): return None
+    name = os.path.basename(url)
+    return name if os.path.isfile(os.path.join(PROFILE_IMAGES_DIR, name)) else None
+
+def _thumb_url(url: Optional[str]) -> Optional[str]:
+    m = PROFILE_NAME_RE.match(os.path.basename(url or ""))
+    return f"/static/images/profiles/{m.group(1)}_thumb.webp" if m else url
+
+def _is_managed(name: str) -> bool:
+    # Hanya file buatan server (hash isi, atau prof_<uuid> versi lama) yang boleh dihapus otomatis
+    return bool(PROFILE_NAME_RE.match(name)) or name.startswith("prof_")
+
+def _variant_files(name: str) -> List[str]:
+    m = PROFILE_NAME_RE.match(name)
+    return [f"{m.group(1)}{suffix}.webp" for suffix in PROFILE_VARIANTS] if m else [name]
+
+def delete_if_orphan(db: Session, url: Optional[str]):
+    name = _profile_file(url)
+    if not name or not _is_managed(name): return
+    if db.query(User.id).filter(User.profile_image.like(f"%/{name}")).first(): return # Masih dipakai user lain
+    # Baru ditulis/dipakai ulang: referensi barunya mungkin belum di-commit, biarkan untuk GC
+    try:
+        if os.path.getmtime(os.path.join(PROFILE_IMAGES_DIR, name)) >= time.time() - ORPHAN_GRACE_S: return
+    except FileNotFoundError: return
+    for f in _variant_files(name):
+        try: os.remove(os.path.join(PROFILE_IMAGES_DIR, f))
+        except FileNotFoundError: pass
+
+@app.on_event("startup")
+def clean_orphan_profile_images():
+    if not PROFILE_GC: return
+    db = SessionLocal()
+    try: dipakai = {os.path.basename(u) for (u,) in db.query(User.profile_image).filter(User.profile_image.isnot(None))}
+    finally: db.close()
+    dipakai |= {f for name in dipakai for f in _variant_files(name)}
+    batas = time.time() - ORPHAN_GRACE_S
+    for name in os.listdir(PROFILE_IMAGES_DIR):
+        path = os.path.join(PROFILE_IMAGES_DIR, name)
+        if _is_managed(name) and name not in dipakai and os.path.getmtime(path) < batas:
+            os.remove(path)
+
+def _profile_dict(u: User) -> dict:
+    img = u.profile_image
+    if img and not img.startswith(('http','/')): img = f"/{img}"
+    return {"id": u.id, "username": u.username, "nama_lengkap": u.nama_lengkap, "alamat": u.alamat,
+            "profile_image": img, "profile_thumb": _thumb_url(img)}
+
+def _url(u: Optional[str]) -> Optional[str]:
+    if u and not u.startswith(('http','/')): return f"/{u}"
+    return u
+
+# --- CACHE RESPONS KATALOG ---
+class ResponseCache:
+    """Body JSON yang sudah diserialisasi dan dikompres, per kunci. Dibuat ulang hanya bila versi
+    data berubah; client yang mengirim If-None-Match / If-Modified-Since yang cocok mendapat 304."""
+
+    def __init__(self):
+        self.entries = {}
+
+    def _build(self, versi, data) -> dict:
+        body = json.dumps(jsonable_encoder(data), ensure_ascii=False, separators=(",", ":")).encode()
+        now = int(time.time())
+        return {
+            "versi": versi,
+            "body": body,
+            "gzip": gzip.compress(body, 6),
+            "br": brotli.compress(body) if brotli else None,
+            "etag": f'"{hashlib.sha1(body).hexdigest()}"',
+            "waktu": now,
+            "last_modified": formatdate(now, usegmt=True),
+        }
+
+    def respond(self, request: Request, key: str, versi, build) -> Response:
+        e = self.entries.get(key)
+        if e is None or e["versi"] != versi:
+            e = self.entries[key] = self._build(versi, build())
+        headers = {"ETag": e["etag"], "Last-Modified": e["last_modified"],
+                   "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+        if self._not_modified(request, e):
+            return Response(status_code=304, headers=headers)
+        ae = request.headers.get("accept-encoding", "")
+        if e["br"] is not None and "br" in ae:
+            body = e["br"]; headers["Content-Encoding"] = "br"
+        elif "gzip" in ae:
+            body = e["gzip"]; headers["Content-Encoding"] = "gzip"
+        else:
+            body = e["body"]
+        return Response(body, media_type="application/json", headers=headers)
+
+    @staticmethod
+    def _not_modified(request: Request, e: dict) -> bool:
+        inm = request.headers.get("if-none-match")
+        if inm is not None:
+            tags = [t.strip().removeprefix("W/") for t in inm.split(",")]
+            return "*" in tags or e["etag"] in tags
+        ims = request.headers.get("if-modified-since")
+        if ims:
+            try: return parsedate_to_datetime(ims).timestamp() >= e["waktu"]
+            except (TypeError, ValueError): return False
+        return False
+
+catalog_cache = ResponseCache()
+
+# --- GEOSPASIAL ---
+def _jarak_m(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    # Haversine, cukup akurat untuk jarak antar rambu di dalam kota
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    a = math.sin((p2 - p1) / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2
+    return 2 * 6371000 * math.asin(math.sqrt(a))
+
+def _bbox_radius(lat: float, lng: float, radius_m: float):
+    dlat = radius_m / 111320
+    dlng = radius_m / (111320 * max(math.cos(math.radians(lat)), 1e-6))
+    return lat - dlat, lat + dlat, lng - dlng, lng + dlng
+
+def _filter_bbox(q, min_lat: float, max_lat: float, min_lng: float, max_lng: float):
+    if SPATIAL_RTREE:
+        # R*Tree menyimpan float32 (dibulatkan keluar), jadi tetap disaring ulang dengan nilai asli
+        q = q.join(jelajahi_rtree, jelajahi_rtree.c.id == Jelajahi.id).filter(
+            jelajahi_rtree.c.max_lat >= min_lat, jelajahi_rtree.c.min_lat <= max_lat,
+            jelajahi_rtree.c.max_lng >= min_lng, jelajahi_rtree.c.min_lng <= max_lng,
+        )
+    return q.filter(Jelajahi.latitude.between(min_lat, max_lat), Jelajahi.longitude.between(min_lng, max_lng))
+
+def _query_jelajahi(db: Session):
+    return db.query(
+        Jelajahi.id, Jelajahi.rambu_id, Jelajahi.latitude, Jelajahi.longitude, 
+        Rambu.nama, Rambu.gambar_url, Rambu.deskripsi, Rambu.kategori,
+        Rambu.nama_en, Rambu.deskripsi_en, Rambu.kategori_en
+    ).join(Rambu, Rambu.id == Jelajahi.rambu_id)
+
+def _jelajahi_dict(r) -> dict:
+    return {**r._asdict(), "gambar_url": _url(r.gambar_url)}
+
+def _terdekat(db: Session, lat: float, lng: float, radius: Optional[float], n: int) -> List[dict]:
+    # Tanpa radius: kotak pencarian diperbesar sampai dapat n lokasi (maks. 50 km).
+    # Urutan dan LIMIT dikerjakan SQLite dengan jarak datar (derajat kuadrat, lng dikali cos lintang);
+    # hanya kandidat teratas (4n) yang dihitung ulang dengan haversine di Python.
+    k = math.cos(math.radians(lat))
+    jarak_kira = (Jelajahi.latitude - lat) * (Jelajahi.latitude - lat) + (Jelajahi.longitude - lng) * (Jelajahi.longitude - lng) * (k * k)
+    r = radius or 1000
+    while True:
+        q = _filter_bbox(_query_jelajahi(db), *_bbox_radius(lat, lng, r))
+        rows = q.order_by(jarak_kira).limit(n * 4).all()
+        out = [{**_jelajahi_dict(x), "jarak_m": round(_jarak_m(lat, lng, x.latitude, x.longitude), 1)} for x in rows]
+        out = [x for x in out if x["jarak_m"] <= r]
+        if radius or len(out) >= n or r >= 50000: break
+        r *= 4
+    out.sort(key=lambda x: x["jarak_m"])
+    return out[:n]
+
+async def read_upload(file: UploadFile, max_bytes: int = MAX_UPLOAD_BYTES) -> bytes:
+    # Dibaca per potongan supaya batas ukuran berlaku tanpa menyalin seluruh file lebih dulu
+    if file.size is not None and file.size > max_bytes: raise HTTPException(413, "Ukuran file terlalu besar")
+    buf = bytearray()
+    while chunk := await file.read(UPLOAD_CHUNK):
+        buf += chunk
+        if len(buf) > max_bytes: raise HTTPException(413, "Ukuran file terlalu besar")
+    return bytes(buf)
+
+def decode_image(data: bytes, max_side: int = AI_IMG_SIZE):
+    """Decode langsung mendekati ukuran input model. Return (gambar RGB, skala ke ukuran asli)."""
+    img = Image.open(io.BytesIO(data))
+    w0, h0 = img.size
+    if img.getexif().get(0x0112) in (5, 6, 7, 8): w0, h0 = h0, w0  # Orientasi EXIF diputar 90 derajat
+    # JPEG: decoder langsung menurunkan skala (1/2, 1/4, 1/8) tanpa decode resolusi penuh
+    img.draft("RGB", (max_side, max_side))
+    img = ImageOps.exif_transpose(img).convert("RGB")
+    if max(img.size) > max_side: img.thumbnail((max_side, max_side), Image.BILINEAR)
+    return img, w0 / img.width
+
+# --- CACHE DETEKSI ---
+def dhash(img: Image.Image, size: int = 16) -> int:
+    # Gradien horizontal gambar grayscale (size+1) x size -> size*size bit
+    px = np.asarray(img.convert("L").resize((size + 1, size), Image.BILINEAR), dtype=np.int16)
+    return int.from_bytes(np.packbits(px[:, 1:] > px[:, :-1]).tobytes(), "big")
+
+def color_key(img: Image.Image) -> tuple:
+    # dHash buta warna (rambu merah vs biru berbentuk sama); rata-rata RGB kasar ikut jadi kunci
+    return tuple(int(c) // 32 for c in np.asarray(img.resize((8, 8), Image.BILINEAR)).reshape(-1, 3).mean(0))
+
+def decode_and_hash(data: bytes):
+    img, skala = decode_image(data)
+    return img, skala, dhash(img), color_key(img)
+
+class DetectionCache:
+    """LRU + TTL untuk respons deteksi. Hanya diakses dari event loop, jadi tanpa lock."""
+
+    def __init__(self, max_size: int, ttl: float, max_distance: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.entries = OrderedDict() # (params, hash) -> (waktu, versi rambu, respons)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, params, h: int) -> Optional[dict]:
+        if not self.max_size: return None
+        now, versi = time.monotonic(), data_versi["rambu"]
+        key = (params, h)
+        if key not in self.entries and self.max_distance:
+            key = next((k for k in reversed(self.entries)
+                        if k[0] == params and (k[1] ^ h).bit_count() <= self.max_distance), key)
+        entry = self.entries.get(key)
+        if entry and (now - entry[0] > self.ttl or entry[1] != versi):
+            del self.entries[key]; entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[2]
+
+    def put(self, params, h: int, response: dict):
+        if not self.max_size: return
+        self.entries[(params, h)] = (time.monotonic(), data_versi["rambu"], response)
+        self.entries.move_to_end((params, h))
+        while len(self.entries) > self.max_size: self.entries.popitem(last=False)
 
-def save_uploaded_file(file: UploadFile, dest: str, prefix: str = "") -> str:
-    ext = os.path.splitext(file.filename)[1]
-    name = f"{prefix}{uuid.uuid4()}{ext}"
-    path = os.path.join(dest, name)
-    with open(path, "wb") as b: shutil.copyfileobj(file.file, b)
-    return f"/static/images/{os.path.basename(dest)}/{name}"
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "ukuran": len(self.entries),
+                "hit_rate": round(self.hits / total, 4) if total else 0.0}
+
+detect_cache = DetectionCache(DETECT_CACHE_SIZE, DETECT_CACHE_TTL, DETECT_CACHE_DISTANCE)
+
+# --- INDEKS KELAS -> RAMBU ---
+class RambuIndex:
+    """Peta id kelas YOLO -> data Rambu, dibangun dari DB dan dibangun ulang saat tabel rambu berubah.
+    Deteksi yang berhasil tidak perlu query SQL sama sekali."""
+
+    def __init__(self):
+        self.versi = -1
+        self.kelas = {}
+        self.lock = asyncio.Lock()
+
+    def get(self, cls_idx: int) -> Optional[dict]:
+        return self.kelas.get(cls_idx)
+
+    async def segarkan(self):
+        # Dibangun ulang di threadpool supaya event loop tidak terblokir; request yang datang bersamaan
+        # menunggu satu rebuild yang sama
+        if self.versi == data_versi["rambu"]: return
+        async with self.lock:
+            if self.versi != data_versi["rambu"]: await run_in_threadpool(self.refresh)
+
+    def refresh(self):
+        versi = data_versi["rambu"]
+        kolom = (Rambu.nama, Rambu.deskripsi, Rambu.kategori, Rambu.nama_en, Rambu.deskripsi_en, Rambu.kategori_en)
+        db = SessionLocal()
+        try:
+            # Hanya baris untuk nama kelas model: cocok persis dulu, lalu nama yang mengandung nama kelas
+            by_nama = {}
+            for r in db.query(*kolom).filter(Rambu.nama.in_(NAMA_KELAS.values())).order_by(Rambu.id):
+                by_nama.setdefault(r.nama, r)
+            kelas = {}
+            for idx, nama in NAMA_KELAS.items():
+                info = by_nama.get(nama) or db.query(*kolom).filter(
+                    func.lower(Rambu.nama).contains(nama.lower(), autoescape=True)).order_by(Rambu.id).first()
+                if info:
+                    kelas[idx] = {
+                        "nama_rambu": info.nama, "deskripsi": info.deskripsi, "kategori": info.kategori,
+                        "nama_en": info.nama_en, "deskripsi_en": info.deskripsi_en, "kategori_en": info.kategori_en,
+                    }
+        finally: db.close()
+        self.kelas, self.versi = kelas, versi
+
+rambu_index = RambuIndex()
+
+@app.on_event("startup")
+def load_rambu_index():
+    rambu_index.refresh()
 
 # --- ENDPOINTS ---
 
 @app.get("/")
 def read_root(): return {"message": "Server Rambuid Ready"}
 
+@app.get("/ready")
+def ready():
+    # Dipakai orchestrator saat rolling restart: 200 hanya jika model sudah termuat
+    body = {"status": "siap" if ai_model is not None else "memuat", **ai_model_info}
+    return JSONResponse(body, status_code=200 if ai_model is not None else 503)
+
 @app.post("/deteksi-rambu/", response_model=AIResponse)
-async def detect_sign_ai(file: UploadFile = File(...), db: Session = Depends(get_db)):
+async def detect_sign_ai(
+    file: UploadFile = File(...),
+    semua: bool = Query(False, description="Kembalikan semua rambu di frame, bukan hanya yang teratas"),
+    top_k: Optional[int] = Query(None, ge=1, le=50, description="Batas jumlah deteksi bila semua=true (default 50)"),
+    min_conf: float = Query(AI_CONF, ge=AI_CONF_MIN, le=1),
+):
     if ai_model is None: raise HTTPException(503, "AI belum siap")
+    top_k = (top_k or 50) if semua else 1 # Tanpa semua hanya deteksi teratas yang dipakai
     try:
-        img_data = await file.read()
-        img = Image.open(io.BytesIO(img_data)).convert("RGB")
+        with ukur("upload"):
+            img_data = await read_upload(file)
+        with ukur("decode"):
+            img, skala, h, warna = await run_in_threadpool(decode_and_hash, img_data)
+
+        # Frame (hampir) sama dengan scan sebelumnya: pakai hasil yang tersimpan
+        params = (img.size, skala, warna, semua, top_k, min_conf) # bbox dalam piksel asli: skala ikut kunci
+        cached = detect_cache.get(params, h)
+        if cached is not None: return cached
         
-        # Prediksi
-        results = ai_model(img)
-        df = results.pandas().xyxy[0]
-
-        # --- DEBUGGING ---
-        print("\n" + "="*30)
-        print(f"--- DEBUG: MATA AI MELIHAT ---")
-        if df.empty:
-            print(">> Tidak melihat apapun.")
-        else:
-            for index, row in df.iterrows():
-                print(f"Kandidat {index+1}: ID {int(row['class'])} ({row['name']}) - Yakin: {row['confidence']:.2f}")
-        print("="*30 + "\n")
-        # -----------------
-
-        if df.empty:
-            return {"status": "sukses", "terdeteksi": False, "pesan": "Tidak ada rambu"}
-
-        top = df.iloc[0]
-        cls_idx = int(top['class'])
-        conf = float(top['confidence'])
-
-        names_dictionary = {
-            0: 'Balai Pertolongan Pertama',
-            1: 'Banyak Anak-Anak',
-            2: 'Banyak Tikungan Pertama Kanan',
-            3: 'Banyak Tikungan Pertama Kiri',
-            4: 'Berhenti',
-            5: 'Dilarang Belok Kanan',
-            6: 'Dilarang Belok Kiri',
-            7: 'Dilarang Berhenti',
-            8: 'Dilarang Masuk',
-            9: 'Dilarang Mendahului',
-            10: 'Dilarang Parkir',
-            11: 'Dilarang Putar Balik',
-            12: 'Gereja',
-            13: 'Hati-Hati',
-            14: 'Ikuti Bundaran',
-            15: 'Jalur Sepeda',
-            16: 'Kecepatan Maks. 30 km',
-            17: 'Kecepatan Maks. 40 km',
-            18: 'Lajur Kiri',
-            19: 'Lampu Lalu Lintas',
-            20: 'Larangan Muatan - 10 ton',
-            21: 'Masjid',
-            22: 'Pemberhentian Bus',
-            23: 'Penyebrangan Pejalan Kaki',
-            24: 'Peringatan Perlintasan Kereta Api',
-            25: 'Perintah Jalur Penyebrangan',
-            26: 'Persimpangan 3 Prioritas',
-            27: 'Persimpangan 3 Prioritas Kanan',
-            28: 'Persimpangan 3 Prioritas Kiri',
-            29: 'Persimpangan 3 Sisi Kiri',
-            30: 'Persimpangan 4',
-            31: 'Pilih Salah Satu Jalur',
-            32: 'Polisi Tidur',
-            33: 'Pom Bensin',
-            34: 'Putar Balik',
-            35: 'Rumah Sakit',
-            36: 'Tempat Parkir',
-            37: 'Tikungan Ganda Pertama Ke Kanan',
-            38: 'Tikungan Ganda Pertama Ke Kiri',
-            39: 'Tikungan Ke Kanan'
-        }
+        # Prediksi (lewat antrian batch, tidak memblokir event loop)
+        # det: tensor (n, 6) = x1, y1, x2, y2, confidence, class, urut confidence menurun
+        det = await ai_batcher.submit(img)
+        det[:, :4] *= skala # Bounding box kembali ke koordinat gambar asli
+        await rambu_index.segarkan()
 
-        detected_name = names_dictionary.get(cls_idx, f"Unknown (ID: {cls_idx})")
+        if logger.isEnabledFor(logging.DEBUG) and random.random() < DEBUG_SAMPLE_RATE:
+            logger.debug("Kandidat deteksi: %s", ", ".join(
+                f"ID {int(cls)} ({NAMA_KELAS.get(int(cls))}) {conf:.2f}" for conf, cls in det[:, 4:6].tolist()) or "-")
 
-        blacklist = [
-            'Dilarang Mendahului', 'Banyak Tikungan Pertama Kanan', 'Banyak Tikungan Pertama Kiri',
-            'Tikungan Ganda Pertama Ke Kanan', 'Tikungan Ganda Pertama Ke Kiri', 'Kecepatan Maks. 30 km', 
-            'Lajur Kiri', 'Larangan Muatan - 10 ton', 'Tikungan Ke Kanan', 'Persimpangan 3 Prioritas'
-        ]
+        hasil = _hasil_deteksi(det, semua, top_k, min_conf)
+        detect_cache.put(params, h, hasil)
+        return hasil
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Error AI")
+        raise HTTPException(500, "Gagal memproses gambar")
 
-        if detected_name in blacklist:
-            return {"status": "sukses", "terdeteksi": False, "pesan": "Objek diabaikan (Blacklist)"}
+@app.websocket("/ws/deteksi")
+async def ws_deteksi(ws: WebSocket, min_conf: float = Query(AI_CONF, ge=AI_CONF_MIN, le=1)):
+    """Live kamera: client mengirim frame JPEG (pesan biner) terus-menerus lewat satu koneksi.
+    Hanya frame terbaru yang diproses (frame lama dibuang bila inferensi tertinggal), label dihaluskan
+    dengan voting beberapa frame, dan server hanya mengirim JSON saat label stabil berubah."""
+    await ws.accept()
+    if ai_model is None:
+        await ws.close(code=1013, reason="AI belum siap")
+        return
 
-        # Cari di DB
-        info = db.query(Rambu).filter(Rambu.nama == detected_name).first()
+    terbaru = {"frame": None}
+    ada_frame = asyncio.Event()
 
-        desc = "Deskripsi belum ada."
-        kat = "Tidak Diketahui"
-        is_detected = True
+    async def terima():
+        while True:
+            msg = await ws.receive()
+            if msg["type"] == "websocket.disconnect": return
+            frame = msg.get("bytes")
+            if frame and len(frame) <= MAX_UPLOAD_BYTES:
+                terbaru["frame"] = frame # Menimpa frame yang belum sempat diproses
+                ada_frame.set()
 
-        if info:
-            desc = info.deskripsi
-            kat = info.kategori
-        else:
-            info_fuzzy = db.query(Rambu).filter(Rambu.nama.ilike(f"%{detected_name}%")).first()
-            if info_fuzzy:
-                desc = info_fuzzy.deskripsi
-                kat = info_fuzzy.kategori
-                detected_name = info_fuzzy.nama
-            else:
-                is_detected = False
-                desc = f"Rambu terdeteksi (ID {cls_idx}) namun dinonaktifkan."
+    penerima = asyncio.create_task(terima())
+    riwayat = deque(maxlen=WS_SMOOTH_FRAMES)
+    hasil_label = {}
+    stabil = ...  # Belum ada label terkirim
+    try:
+        while True:
+            menunggu = asyncio.create_task(ada_frame.wait())
+            await asyncio.wait({penerima, menunggu}, return_when=asyncio.FIRST_COMPLETED)
+            if penerima.done():
+                menunggu.cancel()
+                break
+            ada_frame.clear()
+            frame, terbaru["frame"] = terbaru["frame"], None
 
-        return {
-            "status": "sukses",
-            "terdeteksi": is_detected,
-            "nama_rambu": detected_name if is_detected else "Tidak Terdaftar",
-            "confidence": conf,
-            "deskripsi": desc,
-            "kategori": kat,
-            "pesan": f"Deteksi: {detected_name}"
-        }
-    except Exception as e:
-        print(f"Error AI: {e}")
-        raise HTTPException(500, "Gagal memproses gambar")
+            try:
+                img, skala, h, warna = await run_in_threadpool(decode_and_hash, frame)
+            except Exception:
+                continue # Frame rusak dilewati saja
+            params = (img.size, skala, warna, False, 1, min_conf)
+            hasil = detect_cache.get(params, h)
+            if hasil is None:
+                try:
+                    det = await ai_batcher.submit(img)
+                except HTTPException:
+                    continue # Antrian penuh: frame ini dibuang, frame berikutnya dicoba lagi
+                det[:, :4] *= skala
+                await rambu_index.segarkan()
+                hasil = _hasil_deteksi(det, False, 1, min_conf)
+                detect_cache.put(params, h, hasil)
+
+            label = hasil["nama_rambu"] if hasil["terdeteksi"] else None
+            riwayat.append(label)
+            hasil_label[label] = hasil
+            label, jumlah = Counter(riwayat).most_common(1)[0]
+            if jumlah >= WS_SMOOTH_MIN and label != stabil:
+                stabil = label
+                if penerima.done(): break # Client sudah putus selama inferensi
+                try: await ws.send_json(AIResponse.model_validate(hasil_label[label]).model_dump(mode="json"))
+                except WebSocketDisconnect: break
+    finally:
+        penerima.cancel()
+        await asyncio.gather(penerima, return_exceptions=True)
+
+@app.get("/deteksi-rambu/cache")
+def detect_cache_stats():
+    return detect_cache.stats()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    lines = [
+        *HTTP_LATENCY.render(), *DETEKSI_STAGE.render(), *MODEL_BATCH.render(),
+        *_metric("rambuid_model_queue_depth", "gauge", "Gambar yang menunggu di antrian inferensi", ai_batcher.qsize()),
+        *_metric("rambuid_model_loaded", "gauge", "1 bila model AI sudah termuat", int(ai_model is not None)),
+        *_metric("rambuid_deteksi_cache_hits_total", "counter", "Hit cache deteksi", detect_cache.hits),
+        *_metric("rambuid_deteksi_cache_misses_total", "counter", "Miss cache deteksi", detect_cache.misses),
+        *_metric("rambuid_deteksi_cache_entries", "gauge", "Isi cache deteksi", len(detect_cache.entries)),
+    ]
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+def _hasil_deteksi(det: torch.Tensor, semua: bool, top_k: int, min_conf: float) -> dict:
+    with ukur("postprocess"):
+        det = det[det[:, 4] >= min_conf]
+        ada_kandidat = len(det) > 0
+        det = det[~torch.isin(det[:, 5].long(), BLACKLIST_IDS)]
+        rows = det[det[:, 4].topk(min(top_k, len(det))).indices].tolist()
+
+    if not ada_kandidat:
+        return {"status": "sukses", "terdeteksi": False, "pesan": "Tidak ada rambu"}
+    if not rows:
+        return {"status": "sukses", "terdeteksi": False, "pesan": "Objek diabaikan (Blacklist)"}
+
+    with ukur("lookup"):
+        items = [_info_deteksi(row) for row in rows]
+    top = items[0]
+
+    return {
+        "status": "sukses",
+        "terdeteksi": top["terdeteksi"],
+        "nama_rambu": top["nama_rambu"],
+        "confidence": top["confidence"],
+        "deskripsi": top["deskripsi"],
+        "kategori": top["kategori"],
+        "nama_en": top.get("nama_en"),
+        "deskripsi_en": top.get("deskripsi_en"),
+        "kategori_en": top.get("kategori_en"),
+        "pesan": f"Deteksi: {top['nama_kelas']}",
+        "deteksi": items if semua else None,
+    }
+
+def _info_deteksi(row: List[float]) -> dict:
+    *bbox, conf, cls = row
+    cls_idx = int(cls)
+    item = {"kelas": cls_idx, "confidence": conf, "bbox": [round(v, 1) for v in bbox]}
+    info = rambu_index.get(cls_idx)
+    if info:
+        return {**item, **info, "terdeteksi": True, "nama_kelas": info["nama_rambu"]}
+    return {
+        **item,
+        "terdeteksi": False,
+        "nama_rambu": "Tidak Terdaftar",
+        "nama_kelas": NAMA_KELAS.get(cls_idx, f"Unknown (ID: {cls_idx})"),
+        "deskripsi": f"Rambu terdeteksi (ID {cls_idx}) namun dinonaktifkan.",
+        "kategori": "Tidak Diketahui",
+    }
 
 # === AUTH & USER ===
 @app.post("/register", response_model=RegisterResponse)
-def reg(user: UserSchema, db: Session = Depends(get_db)):
-    if db.query(User).filter(User.username==user.username).first():
+async def reg(user: UserSchema, db: Session = Depends(get_db)):
+    if await run_in_threadpool(lambda: db.query(User).filter(User.username==user.username).first()):
         raise HTTPException(400, "Username ada")
-    new_user = User(username=user.username, password_hash=hash_password(user.password), nama_lengkap=user.nama_lengkap)
-    db.add(new_user); db.commit(); db.refresh(new_user)
+    password_hash = await hash_password(user.password)
+    def simpan():
+        new_user = User(username=user.username, password_hash=password_hash, nama_lengkap=user.nama_lengkap)
+        db.add(new_user); db.commit(); db.refresh(new_user)
+        return new_user
+    new_user = await run_in_threadpool(simpan)
     return {"message": "Daftar sukses", "username": new_user.username, "user_id": new_user.id}
 
 @app.post("/login", response_model=LoginResponse)
-def login(user: UserSchema, db: Session = Depends(get_db)):
-    u = db.query(User).filter(User.username==user.username).first()
-    if not u or not verify_password(user.password, u.password_hash):
+async def login(user: UserSchema, db: Session = Depends(get_db)):
+    u = await run_in_threadpool(lambda: db.query(User).filter(User.username==user.username).first())
+    ok, new_hash = await verify_password(user.password, u.password_hash) if u else (False, None)
+    if not ok:
         raise HTTPException(400, "Login gagal")
+    if new_hash:
+        # Hash lama (rounds lebih rendah) di-upgrade otomatis setelah login berhasil
+        u.password_hash = new_hash
+        await run_in_threadpool(db.commit)
     return {"message": "Login sukses", "user_id": u.id, "username": u.username}
 
 @app.get("/users/{uid}/profile", response_model=UserProfileResponse)
 def get_prof(uid: int, db: Session = Depends(get_db)):
     u = db.query(User).filter(User.id==uid).first()
     if not u: raise HTTPException(404, "User 404")
-    if u.profile_image and not u.profile_image.startswith(('http','/')): u.profile_image = f"/{u.profile_image}"
-    return u
+    return _profile_dict(u)
 
 @app.put("/users/{uid}/profile", response_model=UserProfileResponse)
-def upd_prof(uid: int, nama_lengkap: Optional[str]=Form(None), username: Optional[str]=Form(None), alamat: Optional[str]=Form(None), password: Optional[str]=Form(None), profile_image: Optional[UploadFile]=File(None), db: Session=Depends(get_db)):
-    u = db.query(User).filter(User.id==uid).first()
-    if not u: raise HTTPException(404, "User 404")
-    if nama_lengkap: u.nama_lengkap = nama_lengkap
-    if username and username != u.username:
-        if db.query(User).filter(User.username==username).first(): raise HTTPException(400, "Username terpakai")
-        u.username = username
-    if alamat: u.alamat = alamat
-    if password and len(password)>=6: u.password_hash = hash_password(password)
+async def upd_prof(uid: int, nama_lengkap: Optional[str]=Form(None), username: Optional[str]=Form(None), alamat: Optional[str]=Form(None), password: Optional[str]=Form(None), profile_image: Optional[UploadFile]=File(None), db: Session=Depends(get_db)):
+    def periksa():
+        # Dicek lebih dulu supaya hash password dan tulis WebP hanya dikerjakan untuk request yang valid
+        u = db.query(User).filter(User.id==uid).first()
+        if not u: raise HTTPException(404, "User 404")
+        if username and username != u.username and db.query(User).filter(User.username==username).first():
+            raise HTTPException(400, "Username terpakai")
+    await run_in_threadpool(periksa)
+    password_hash = await hash_password(password) if password and len(password)>=6 else None
+    image_url = None
     if profile_image:
-        u.profile_image = save_uploaded_file(profile_image, PROFILE_IMAGES_DIR, "prof_")
-    db.commit(); db.refresh(u)
-    if u.profile_image and not u.profile_image.startswith(('http','/')): u.profile_image = f"/{u.profile_image}"
-    return u
+        image_url = await run_in_threadpool(save_profile_image, await read_upload(profile_image))
+    def update():
+        u = db.query(User).filter(User.id==uid).first()
+        if not u: raise HTTPException(404, "User 404")
+        if nama_lengkap: u.nama_lengkap = nama_lengkap
+        if username and username != u.username:
+            if db.query(User).filter(User.username==username).first(): raise HTTPException(400, "Username terpakai")
+            u.username = username
+        if alamat: u.alamat = alamat
+        if password_hash: u.password_hash = password_hash
+        old_image = u.profile_image
+        if image_url: u.profile_image = image_url
+        db.commit(); db.refresh(u)
+        if old_image != u.profile_image: delete_if_orphan(db, old_image)
+        return _profile_dict(u)
+    # File yang sudah ditulis lalu update() gagal (kalah balapan username) tidak dihapus di sini: bisa jadi
+    # request lain baru saja memakai file yang sama lewat dedupe. GC (PROFILE_GC=1) yang membersihkannya.
+    return await run_in_threadpool(update)
 
 @app.delete("/users/{uid}/profile-image")
 def del_prof_img(uid: int, db: Session=Depends(get_db)):
     u = db.query(User).filter(User.id==uid).first()
     if not u: raise HTTPException(404)
+    old_image = u.profile_image
     u.profile_image = None
     db.commit()
+    delete_if_orphan(db, old_image)
     return {"message": "Foto dihapus"}
 
 # === RAMBU & JELAJAHI ===
 @app.get("/rambu/", response_model=List[RambuResponse])
-def all_rambu(db: Session=Depends(get_db)):
-    res = db.query(Rambu).all()
-    for r in res:
-        if r.gambar_url and not r.gambar_url.startswith(('http','/')): r.gambar_url = f"/{r.gambar_url}"
-    return res
+def all_rambu(request: Request, db: Session=Depends(get_db)):
+    def build():
+        res = db.query(
+            Rambu.id, Rambu.nama, Rambu.gambar_url, Rambu.deskripsi, Rambu.kategori,
+            Rambu.nama_en, Rambu.deskripsi_en, Rambu.kategori_en
+        ).all()
+        return [{**r._asdict(), "gambar_url": _url(r.gambar_url)} for r in res]
+    # Versi dibaca langsung dari DB (satu baris), supaya tidak ada body/304 basi antar worker
+    data_versi.segarkan()
+    return catalog_cache.respond(request, "rambu", data_versi["rambu"], build)
 
-@app.get("/jelajahi/", response_model=List[JelajahiWithRambuResponse])
-def all_jelajahi(db: Session=Depends(get_db)):
-    # UPDATED: Menambahkan Rambu.nama_en, deskripsi_en, kategori_en ke query
+@app.get("/rambu/search", response_model=List[RambuResponse])
+def search_rambu(
+    q: str = Query(..., min_length=1, max_length=100),
+    kategori: Optional[str] = Query(None),
+    lang: str = Query("id", pattern="^(id|en)$"),
+    limit: int = Query(20, ge=1, le=100),
+    db: Session=Depends(get_db),
+):
+    tokens = re.findall(r"\w+", q.lower())
+    if not tokens: return []
+    kat_col = "kategori" if lang == "id" else "kategori_en"
+    if SEARCH_FTS:
+        # Tiap kata dicari sebagai prefix (AND), hanya di kolom bahasa yang dipilih
+        cols = "{nama deskripsi kategori}" if lang == "id" else "{nama_en deskripsi_en kategori_en}"
+        match = f"{cols} : (" + " ".join(f'"{t}"*' for t in tokens) + ")"
+        sql = f"""SELECT r.id, r.nama, r.gambar_url, r.deskripsi, r.kategori, r.nama_en, r.deskripsi_en, r.kategori_en
+            FROM rambu_fts JOIN rambu r ON r.id = rambu_fts.rowid
+            WHERE rambu_fts MATCH :match {f"AND lower(r.{kat_col}) = lower(:kategori)" if kategori else ""}
+            ORDER BY bm25(rambu_fts, 10.0, 1.0, 10.0, 1.0, 2.0, 2.0) LIMIT :limit"""
+        rows = db.execute(text(sql), {"match": match, "kategori": kategori, "limit": limit}).all()
+        return [{**r._asdict(), "gambar_url": _url(r.gambar_url)} for r in rows]
+
+    nama_col = Rambu.nama if lang == "id" else Rambu.nama_en
+    desk_col = Rambu.deskripsi if lang == "id" else Rambu.deskripsi_en
     res = db.query(
-        Jelajahi.id, Jelajahi.rambu_id, Jelajahi.latitude, Jelajahi.longitude, 
-        Rambu.nama, Rambu.gambar_url, Rambu.deskripsi, Rambu.kategori,
-        Rambu.nama_en, Rambu.deskripsi_en, Rambu.kategori_en # <-- Field baru
-    ).join(Rambu).all()
-    
-    out = []
-    for r in res:
-        url = r.gambar_url
-        if url and not url.startswith(('http','/')): url = f"/{url}"
-        out.append({
-            "id":r.id, "rambu_id":r.rambu_id, "latitude":r.latitude, "longitude":r.longitude, 
-            "nama":r.nama, "gambar_url":url, "deskripsi":r.deskripsi, "kategori":r.kategori,
-            "nama_en": r.nama_en, "deskripsi_en": r.deskripsi_en, "kategori_en": r.kategori_en # <-- Map field baru
-        })
-    return out
+        Rambu.id, Rambu.nama, Rambu.gambar_url, Rambu.deskripsi, Rambu.kategori,
+        Rambu.nama_en, Rambu.deskripsi_en, Rambu.kategori_en
+    )
+    for t in tokens: res = res.filter(or_(nama_col.ilike(f"%{t}%"), desk_col.ilike(f"%{t}%")))
+    if kategori: res = res.filter(func.lower(getattr(Rambu, kat_col)) == kategori.lower())
+    return [{**r._asdict(), "gambar_url": _url(r.gambar_url)} for r in res.limit(limit).all()]
+
+@app.get("/jelajahi/", response_model=List[JelajahiWithRambuResponse])
+def all_jelajahi(
+    request: Request,
+    response: Response,
+    min_lat: Optional[float] = Query(None, ge=-90, le=90),
+    min_lng: Optional[float] = Query(None, ge=-180, le=180),
+    max_lat: Optional[float] = Query(None, ge=-90, le=90),
+    max_lng: Optional[float] = Query(None, ge=-180, le=180),
+    lat: Optional[float] = Query(None, ge=-90, le=90, description="Pusat pencarian radius / terdekat"),
+    lng: Optional[float] = Query(None, ge=-180, le=180),
+    radius: Optional[float] = Query(None, gt=0, le=50000, description="Meter"),
+    limit: Optional[int] = Query(None, ge=1, le=5000),
+    cursor: Optional[int] = Query(None, description="Nilai X-Next-Cursor dari halaman sebelumnya"),
+    db: Session=Depends(get_db),
+):
+    bbox = (min_lat, max_lat, min_lng, max_lng)
+    if all(v is None for v in (*bbox, lat, lng, radius, limit, cursor)):
+        def build():
+            return [_jelajahi_dict(r) for r in _query_jelajahi(db).all()]
+        data_versi.segarkan()
+        versi = (data_versi["rambu"], data_versi["jelajahi"])
+        return catalog_cache.respond(request, "jelajahi", versi, build)
+
+    if (lat is None) != (lng is None): raise HTTPException(400, "lat dan lng harus diisi bersamaan")
+    if lat is not None:
+        return _terdekat(db, lat, lng, radius, limit or 50)
+
+    q = _query_jelajahi(db)
+    if any(v is not None for v in bbox):
+        if any(v is None for v in bbox): raise HTTPException(400, "Bounding box butuh min_lat, min_lng, max_lat, max_lng")
+        q = _filter_bbox(q, *bbox)
+    if cursor is not None: q = q.filter(Jelajahi.id > cursor)
+    limit = limit or 500
+    rows = q.order_by(Jelajahi.id).limit(limit).all()
+    if len(rows) == limit: response.headers["X-Next-Cursor"] = str(rows[-1].id)
+    return [_jelajahi_dict(r) for r in rows]
+
+@app.get("/jelajahi/cluster", response_model=List[JelajahiCluster])
+def cluster_jelajahi(
+    zoom: int = Query(..., ge=0, le=22),
+    min_lat: float = Query(-90, ge=-90, le=90),
+    min_lng: float = Query(-180, ge=-180, le=180),
+    max_lat: float = Query(90, ge=-90, le=90),
+    max_lng: float = Query(180, ge=-180, le=180),
+    db: Session=Depends(get_db),
+):
+    # Grid per zoom: kira-kira 4 sel per tile peta 256 px
+    sel = 360 / (2 ** zoom) / 4
+    gx = cast((Jelajahi.latitude + 90) / sel, Integer)
+    gy = cast((Jelajahi.longitude + 180) / sel, Integer)
+    q = db.query(
+        func.count(Jelajahi.id).label("jumlah"),
+        func.avg(Jelajahi.latitude).label("latitude"), func.avg(Jelajahi.longitude).label("longitude"),
+        func.min(Jelajahi.id).label("id"), func.min(Jelajahi.rambu_id).label("rambu_id"),
+    )
+    rows = _filter_bbox(q, min_lat, max_lat, min_lng, max_lng).group_by(gx, gy).all()
+    return [
+        {"latitude": r.latitude, "longitude": r.longitude, "jumlah": r.jumlah,
+         "id": r.id if r.jumlah == 1 else None, "rambu_id": r.rambu_id if r.jumlah == 1 else None}
+        for r in rows
+    ]
 
 @app.post("/jelajahi/", response_model=JelajahiResponse)
 def add_loc(d: JelajahiCreate, db: Session=Depends(get_db)):
     new_loc = Jelajahi(rambu_id=d.rambu_id, latitude=d.latitude, longitude=d.longitude)
     db.add(new_loc); db.commit(); db.refresh(new_loc)
+    data_versi.segarkan()
     return new_loc
 
+JELAJAHI_INSERT_DEDUPE = text("""INSERT INTO jelajahi (rambu_id, latitude, longitude)
+    SELECT :rambu_id, :latitude, :longitude WHERE NOT EXISTS (
+        SELECT 1 FROM jelajahi WHERE rambu_id = :rambu_id
+        AND round(latitude, 5) = round(:latitude, 5) AND round(longitude, 5) = round(:longitude, 5))""")
+
+def _baris_teks(raw):
+    # Decode per baris: byte yang bukan UTF-8 hanya menggagalkan baris itu, bukan seluruh import
+    for n, b in enumerate(raw, start=1):
+        if n == 1: b = b.removeprefix(codecs.BOM_UTF8)
+        try: yield n, b.decode("utf-8")
+        except UnicodeDecodeError as e: yield n, ValueError(f"Bukan teks UTF-8 (byte ke-{e.start + 1}: {e.reason})")
+
+def _baris_import(file: UploadFile, format: Optional[str]):
+    # Dibaca baris per baris dari file upload (spooled ke disk), tidak dimuat utuh ke memori.
+    # Baris yang rusak di-yield sebagai Exception supaya dicatat di daftar error, bukan jadi 500.
+    if format is None:
+        csv_like = (file.filename or "").lower().endswith(".csv") or (file.content_type or "").startswith("text/csv")
+        format = "csv" if csv_like else "ndjson"
+    if format == "csv":
+        salah, baris = [], [0] # baris[0] = nomor baris fisik terakhir yang dibaca DictReader
+        def teks():
+            for n, line in _baris_teks(file.file):
+                baris[0] = n
+                if isinstance(line, Exception): salah.append((n, line)); yield "\n" # Dilewati DictReader sebagai baris kosong
+                else: yield line
+        reader = csv.DictReader(teks())
+        while True:
+            try: row = next(reader)
+            except StopIteration: break
+            except csv.Error as e: row = ValueError(f"CSV tidak valid: {e}")
+            yield from salah; salah.clear()
+            yield baris[0], row
+        yield from salah
+    else:
+        for n, line in _baris_teks(file.file):
+            if isinstance(line, Exception): yield n, line; continue
+            if not line.strip(): continue
+            try: yield n, json.loads(line)
+            except json.JSONDecodeError as e: yield n, ValueError(f"JSON tidak valid: {e}")
+
+@app.post("/jelajahi/import", response_model=JelajahiImportResponse)
+def import_jelajahi(
+    file: UploadFile = File(..., description="NDJSON atau CSV berkolom rambu_id, latitude, longitude"),
+    format: Optional[str] = Query(None, pattern="^(csv|ndjson)$"),
+    dedupe: bool = Query(False, description="Lewati lokasi dengan rambu_id dan koordinat (5 desimal) yang sudah ada"),
+):
+    with engine.connect() as conn:
+        rambu_ids = set(conn.execute(text("SELECT id FROM rambu")).scalars())
+    stmt = JELAJAHI_INSERT_DEDUPE if dedupe else insert(Jelajahi.__table__)
+    hasil = {"total": 0, "ditambahkan": 0, "duplikat": 0, "gagal": 0, "error": []}
+    seen, chunk = set(), []
+
+    def gagal(n, pesan):
+        hasil["gagal"] += 1
+        if len(hasil["error"]) < IMPORT_MAX_ERRORS: hasil["error"].append({"baris": n, "pesan": pesan})
+
+    def flush():
+        # Satu transaksi per potongan: lock tulis SQLite tidak ditahan selama seluruh import
+        with engine.begin() as conn:
+            ditambahkan = conn.execute(stmt, chunk).rowcount
+        hasil["ditambahkan"] += ditambahkan
+        hasil["duplikat"] += len(chunk) - ditambahkan
+        chunk.clear()
+
+    for n, row in _baris_import(file, format):
+        hasil["total"] += 1
+        if isinstance(row, Exception): gagal(n, str(row)); continue
+        try: d = JelajahiCreate.model_validate(row)
+        except ValidationError as e: gagal(n, "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors())); continue
+        if d.rambu_id not in rambu_ids: gagal(n, f"rambu_id {d.rambu_id} tidak ada"); continue
+        if not (-90 <= d.latitude <= 90 and -180 <= d.longitude <= 180): gagal(n, "Koordinat di luar jangkauan"); continue
+        if dedupe:
+            key = (d.rambu_id, round(d.latitude, 5), round(d.longitude, 5))
+            if key in seen: hasil["duplikat"] += 1; continue
+            seen.add(key)
+        chunk.append(d.model_dump())
+        if len(chunk) >= IMPORT_CHUNK: flush()
+    if chunk: flush()
+
+    if hasil["ditambahkan"]: data_versi.segarkan()
+    return hasil
+
 # Endpoint Admin/Stats
 @app.get("/users/")
 def all_users(db: Session=Depends(get_db)): return db.query(User).all()
@@ -418,4 +1581,6 @@ def stats(db: Session=Depends(get_db)):
     return {"total_users": db.query(User).count(), "total_rambu": db.query(Rambu).count(), "total_jelajahi": db.query(Jelajahi).count()}
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Sama dengan start_server.bat/.ps1. Bukan uvicorn.run(app): process pool hash (spawn) meng-import ulang
+    # modul __main__ di tiap anak proses, dan bila itu app.py ikut memuat torch, model dan DDL di sana.
+    os.execv(sys.executable, [sys.executable, "-m", "uvicorn", "app:app", "--app-dir", BASE_DIR, "--host", "0.0.0.0", "--port", "8000"])
\ No newline at end of file
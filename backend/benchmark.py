@@ -0,0 +1,306 @@
+# Benchmark & load test RambuID API, tanpa best.pt (model diganti stub deterministik).
+#
+#   python benchmark.py seed --db bench.db --rambu 10000 --jelajahi 1000000 --users 100000
+#   python benchmark.py run --db bench.db --concurrency 32 --duration 30 --save baseline.json
+#   python benchmark.py run --db bench.db --concurrency 32 --duration 30 --baseline baseline.json
+#
+# "run" menjalankan server di subprocess (python benchmark.py serve ...) lalu menembak endpoint
+# secara bersamaan dan melaporkan throughput serta latensi p50/p95/p99 per skenario.
+# Dengan --baseline, hasil dibandingkan ke run tersimpan dan exit code 1 bila ada regresi.
+import argparse
+import io
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_PASSWORD = "benchpass"
+
+# Area Batam
+LAT_MIN, LAT_MAX = 0.95, 1.20
+LNG_MIN, LNG_MAX = 103.90, 104.15
+
+# Bobot default skenario; /jelajahi/ penuh tidak ikut karena dengan 1 juta baris ukurannya ratusan MB
+DEFAULT_MIX = "deteksi=3,rambu=1,rambu_304=2,jelajahi_bbox=3,jelajahi_near=2,jelajahi_cluster=2,login=2,stats=1"
+
+
+def _db_url(path: str) -> str:
+    return f"sqlite:///{os.path.abspath(path)}"
+
+
+def _import_app(db: str):
+    # app.py membaca DATABASE_URL saat di-import, dan harus dijalankan dari folder backend
+    os.environ["DATABASE_URL"] = _db_url(db)
+    os.chdir(BASE_DIR)
+    sys.path.insert(0, BASE_DIR)
+    import app
+    return app
+
+
+# === SEED ===
+def seed(args):
+    args.db = os.path.abspath(args.db)  # _import_app pindah ke folder backend
+    if os.path.exists(args.db):
+        if not args.force: sys.exit(f"{args.db} sudah ada, pakai --force untuk menimpa")
+        for ext in ("", "-wal", "-shm"):
+            if os.path.exists(args.db + ext): os.remove(args.db + ext)
+    app = _import_app(args.db)  # Membuat tabel, R*Tree, FTS5 dan trigger-nya
+    import hashing
+
+    rnd = random.Random(args.seed)
+    kategori = [("Larangan", "Prohibition"), ("Peringatan", "Warning"), ("Perintah", "Mandatory"), ("Petunjuk", "Guide")]
+    conn = sqlite3.connect(args.db)
+    t0 = time.perf_counter()
+
+    # 40 baris pertama memakai nama kelas model supaya deteksi stub bisa di-resolve
+    nama = list(app.NAMA_KELAS.values())
+    rows = []
+    for i in range(args.rambu):
+        n = nama[i] if i < len(nama) else f"Rambu Sintetis {i}"
+        k, k_en = kategori[i % len(kategori)]
+        rows.append((n, f"static/images/rambu/r{i}.png", f"Deskripsi {n} untuk pengendara", k,
+                     f"Synthetic Sign {i}", f"Description of sign {i} for drivers", k_en))
+    conn.executemany("INSERT INTO rambu (nama, gambar_url, deskripsi, kategori, nama_en, deskripsi_en, kategori_en) "
+                     "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+    conn.commit()
+
+    batch = 50000
+    for start in range(0, args.jelajahi, batch):
+        rows = [(rnd.randint(1, args.rambu), rnd.uniform(LAT_MIN, LAT_MAX), rnd.uniform(LNG_MIN, LNG_MAX))
+                for _ in range(min(batch, args.jelajahi - start))]
+        conn.executemany("INSERT INTO jelajahi (rambu_id, latitude, longitude) VALUES (?, ?, ?)", rows)
+        conn.commit()
+
+    # Satu hash dipakai semua user: hashing 100 ribu password PBKDF2 hanya membuang waktu seed
+    pw = hashing.hash_password(BENCH_PASSWORD)
+    for start in range(0, args.users, batch):
+        rows = [(f"user{i}", pw, f"User {i}") for i in range(start, min(start + batch, args.users))]
+        conn.executemany("INSERT INTO users (username, password_hash, nama_lengkap) VALUES (?, ?, ?)", rows)
+        conn.commit()
+    conn.close()
+    print(f"Seed selesai: {args.rambu} rambu, {args.jelajahi} jelajahi, {args.users} users ({time.perf_counter() - t0:.1f} s)")
+
+
+# === SERVER ===
+class StubDetector:
+    """Pengganti ai_model: hasil deterministik dari isi gambar, latensi disimulasikan dengan sleep
+    (forward pass torch juga melepas GIL)."""
+    backend = "stub"
+
+    def __init__(self, names: dict, batch_ms: float, img_ms: float):
+        self.names = names
+        self.batch_ms = batch_ms
+        self.img_ms = img_ms
+
+    def __call__(self, imgs):
+        import numpy as np
+        import torch
+        time.sleep((self.batch_ms + self.img_ms * len(imgs)) / 1000)
+        out = []
+        for img in imgs:
+            w, h = img.size
+            cls = int(np.asarray(img.resize((4, 4))).sum()) % len(self.names)
+            out.append(torch.tensor([[w * 0.25, h * 0.25, w * 0.75, h * 0.75, 0.9, float(cls)]]))
+        return out
+
+
+def serve(args):
+    args.db = os.path.abspath(args.db)
+    app = _import_app(args.db)
+    import uvicorn
+    # DB sintetis tidak mereferensikan foto profil asli di static/: GC file yatim jangan sampai menghapusnya
+    app.app.router.on_startup.remove(app.clean_orphan_profile_images)
+    app.ai_model = StubDetector(app.NAMA_KELAS, args.stub_batch_ms, args.stub_img_ms)
+    app.ai_model_info.update(backend="stub", waktu_muat=0.0)
+    uvicorn.run(app.app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+# === LOAD TEST ===
+def _images(n: int, seed: int):
+    from PIL import Image
+    rnd = random.Random(seed)
+    out = []
+    for _ in range(n):
+        img = Image.effect_noise((320, 240), rnd.uniform(20, 80)).convert("RGB")
+        buf = io.BytesIO()
+        img.resize((1280, 960)).save(buf, "JPEG", quality=85)
+        out.append(buf.getvalue())
+    return out
+
+
+def _scenarios(base: str, args, s, rnd, images, etag):
+    def viewport():
+        lat, lng = rnd.uniform(LAT_MIN, LAT_MAX), rnd.uniform(LNG_MIN, LNG_MAX)
+        return {"min_lat": lat, "max_lat": lat + 0.01, "min_lng": lng, "max_lng": lng + 0.01}
+
+    return {
+        "deteksi": lambda: s.post(f"{base}/deteksi-rambu/", files={"file": ("scan.jpg", rnd.choice(images), "image/jpeg")}),
+        "rambu": lambda: s.get(f"{base}/rambu/"),
+        "rambu_304": lambda: s.get(f"{base}/rambu/", headers={"If-None-Match": etag}),
+        "jelajahi": lambda: s.get(f"{base}/jelajahi/"),
+        "jelajahi_bbox": lambda: s.get(f"{base}/jelajahi/", params={**viewport(), "limit": 500}),
+        "jelajahi_near": lambda: s.get(f"{base}/jelajahi/", params={
+            "lat": rnd.uniform(LAT_MIN, LAT_MAX), "lng": rnd.uniform(LNG_MIN, LNG_MAX), "limit": 20}),
+        "jelajahi_cluster": lambda: s.get(f"{base}/jelajahi/cluster", params={
+            "zoom": 13, "min_lat": LAT_MIN, "max_lat": LAT_MAX, "min_lng": LNG_MIN, "max_lng": LNG_MAX}),
+        "login": lambda: s.post(f"{base}/login", json={
+            "username": f"user{rnd.randrange(args.users)}", "password": BENCH_PASSWORD}),
+        "stats": lambda: s.get(f"{base}/stats/"),
+    }
+
+
+def _percentile(sorted_ms, p):
+    if not sorted_ms: return 0.0
+    return sorted_ms[min(len(sorted_ms) - 1, int(round(p / 100 * (len(sorted_ms) - 1))))]
+
+
+def _wait_ready(base: str, proc, timeout: float = 120):
+    import requests
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None: sys.exit("Server berhenti sebelum siap")
+        try:
+            if requests.get(f"{base}/ready", timeout=1).status_code == 200: return
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    sys.exit("Server tidak siap dalam batas waktu")
+
+
+def run(args):
+    import requests
+    if not os.path.exists(args.db): sys.exit(f"{args.db} belum ada, jalankan 'seed' dulu")
+    mix = {k: float(v) for k, v in (item.split("=") for item in args.mix.split(","))}
+    base = f"http://127.0.0.1:{args.port}"
+    cmd = [sys.executable, os.path.abspath(__file__), "serve", "--db", os.path.abspath(args.db), "--port", str(args.port),
+           "--stub-batch-ms", str(args.stub_batch_ms), "--stub-img-ms", str(args.stub_img_ms)]
+    proc = subprocess.Popen(cmd, cwd=BASE_DIR)
+    try:
+        _wait_ready(base, proc)
+        images = _images(32, args.seed)
+        etag = requests.get(f"{base}/rambu/").headers.get("ETag", "")
+        names = list(mix)
+        unknown = set(names) - set(_scenarios(base, args, None, None, images, etag))
+        if unknown: sys.exit(f"Skenario tidak dikenal: {', '.join(sorted(unknown))}")
+        weights = [mix[n] for n in names]
+
+        hasil = {n: [] for n in names}  # nama -> [(latensi ms, ok)]
+        lock = threading.Lock()
+        mulai = time.perf_counter() + args.warmup
+        selesai = mulai + args.duration
+
+        def worker(i):
+            rnd = random.Random(args.seed + i)
+            s = requests.Session()
+            calls = _scenarios(base, args, s, rnd, images, etag)
+            lokal = []
+            while True:
+                now = time.perf_counter()
+                if now >= selesai: break
+                name = rnd.choices(names, weights)[0]
+                t0 = time.perf_counter()
+                try:
+                    ok = calls[name]().status_code in (200, 304)
+                except requests.RequestException:
+                    ok = False
+                if t0 >= mulai: lokal.append((name, (time.perf_counter() - t0) * 1000, ok))
+            with lock:
+                for name, ms, ok in lokal: hasil[name].append((ms, ok))
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.concurrency)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+
+    report = {"config": {"concurrency": args.concurrency, "duration": args.duration, "mix": mix,
+                         "stub_batch_ms": args.stub_batch_ms, "stub_img_ms": args.stub_img_ms},
+              "scenarios": {}}
+    for name, samples in hasil.items():
+        ms = sorted(m for m, _ in samples)
+        report["scenarios"][name] = {
+            "requests": len(samples),
+            "errors": sum(1 for _, ok in samples if not ok),
+            "rps": round(len(samples) / args.duration, 2),
+            "p50_ms": round(_percentile(ms, 50), 2),
+            "p95_ms": round(_percentile(ms, 95), 2),
+            "p99_ms": round(_percentile(ms, 99), 2),
+        }
+    _print_report(report)
+
+    if args.save:
+        with open(args.save, "w") as f: json.dump(report, f, indent=2)
+        print(f"Hasil disimpan ke {args.save}")
+    if args.baseline:
+        with open(args.baseline) as f: baseline = json.load(f)
+        if _compare(report, baseline, args.tolerance): sys.exit(1)
+
+
+def _print_report(report):
+    print(f"\n{'skenario':<18}{'req':>8}{'err':>6}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, r in report["scenarios"].items():
+        print(f"{name:<18}{r['requests']:>8}{r['errors']:>6}{r['rps']:>10}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}")
+
+
+def _compare(report, baseline, tolerance: float) -> bool:
+    """Cetak selisih terhadap baseline. Return True bila ada regresi melebihi toleransi."""
+    regresi = False
+    print(f"\nDibanding baseline (toleransi {tolerance:.0%}):")
+    for name, r in report["scenarios"].items():
+        b = baseline.get("scenarios", {}).get(name)
+        if not b:
+            print(f"  {name}: tidak ada di baseline")
+            continue
+        catatan = []
+        if b["p95_ms"] and r["p95_ms"] > b["p95_ms"] * (1 + tolerance):
+            catatan.append(f"p95 {b['p95_ms']} -> {r['p95_ms']} ms")
+        if b["rps"] and r["rps"] < b["rps"] * (1 - tolerance):
+            catatan.append(f"rps {b['rps']} -> {r['rps']}")
+        if r["errors"] > b["errors"]:
+            catatan.append(f"error {b['errors']} -> {r['errors']}")
+        regresi |= bool(catatan)
+        print(f"  {name}: {'REGRESI ' + '; '.join(catatan) if catatan else 'ok'}")
+    return regresi
+
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark & load test RambuID API")
+    sub = p.add_subparsers(dest="cmd", required=True)
+
+    s = sub.add_parser("seed", help="Buat DB SQLite sintetis")
+    s.add_argument("--db", default="bench.db")
+    s.add_argument("--rambu", type=int, default=10000)
+    s.add_argument("--jelajahi", type=int, default=1000000)
+    s.add_argument("--users", type=int, default=100000)
+    s.add_argument("--seed", type=int, default=42)
+    s.add_argument("--force", action="store_true")
+
+    for name in ("run", "serve"):
+        r = sub.add_parser(name, help="Jalankan load test" if name == "run" else "Server dengan stub detector (dipakai 'run')")
+        r.add_argument("--db", default="bench.db")
+        r.add_argument("--port", type=int, default=8765)
+        r.add_argument("--stub-batch-ms", type=float, default=15, help="Latensi stub per batch")
+        r.add_argument("--stub-img-ms", type=float, default=5, help="Latensi stub per gambar dalam batch")
+    r = sub.choices["run"]
+    r.add_argument("--concurrency", type=int, default=32)
+    r.add_argument("--duration", type=float, default=30, help="Detik pengukuran")
+    r.add_argument("--warmup", type=float, default=3, help="Detik awal yang tidak diukur")
+    r.add_argument("--mix", default=DEFAULT_MIX, help="Bobot skenario, mis. deteksi=3,rambu=1")
+    r.add_argument("--users", type=int, default=100000, help="Jumlah user hasil seed (untuk login acak)")
+    r.add_argument("--seed", type=int, default=42)
+    r.add_argument("--save", help="Simpan hasil ke file JSON (jadikan baseline)")
+    r.add_argument("--baseline", help="Bandingkan dengan hasil tersimpan; exit 1 bila regresi")
+    r.add_argument("--tolerance", type=float, default=0.15)
+
+    args = p.parse_args()
+    {"seed": seed, "run": run, "serve": serve}[args.cmd](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,16 @@
+# Mode produksi multi-worker (Linux):
+#   gunicorn -c gunicorn.conf.py app:app
+# App (termasuk model AI) dimuat sekali di master lalu di-fork ke N worker uvicorn,
+# sehingga bobot model dipakai bersama (copy-on-write) dan tidak dimuat N kali.
+# Tiap worker punya cache sendiri (katalog, indeks kelas, hasil deteksi); semuanya dicocokkan
+# ke versi di tabel data_versi SQLite (dinaikkan trigger), jadi tulisan di satu worker terlihat di semua.
+import os
+
+bind = os.getenv("RAMBUID_BIND", "0.0.0.0:8000")
+workers = int(os.environ.setdefault("RAMBUID_WORKERS", str(os.cpu_count() or 1)))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+timeout = 120
+
+# Dibaca app.py saat di-import oleh master
+os.environ.setdefault("RAMBUID_PRELOAD_MODEL", "1")
@@ -0,0 +1,25 @@
+# Hash password PBKDF2 (sengaja berat di CPU). Modul ini sengaja kecil dan terpisah dari app.py:
+# fungsi di sini dijalankan di process pool (spawn), jadi proses worker cukup mengimpor passlib saja.
+# Syaratnya modul __main__ bukan app.py (spawn meng-import ulang __main__): jalankan lewat
+# `uvicorn app:app` atau gunicorn; `python app.py` pun diteruskan ke CLI uvicorn.
+import os
+
+from passlib.context import CryptContext
+
+PBKDF2_ROUNDS = int(os.getenv("PBKDF2_ROUNDS", "29000"))
+
+# min_rounds = default_rounds: hash lama dengan rounds lebih rendah dianggap perlu di-upgrade
+pwd_context = CryptContext(
+    schemes=["pbkdf2_sha256"],
+    deprecated="auto",
+    pbkdf2_sha256__default_rounds=PBKDF2_ROUNDS,
+    pbkdf2_sha256__min_rounds=PBKDF2_ROUNDS,
+)
+
+def hash_password(p: str) -> str:
+    return pwd_context.hash(p)
+
+def verify_password(p: str, h: str):
+    """Return (cocok, hash_baru). hash_baru berisi hash dengan setelan terkini bila hash lama perlu di-upgrade."""
+    if not pwd_context.verify(p, h): return False, None
+    return True, pwd_context.hash(p) if pwd_context.needs_update(h) else None